@@ -26,6 +26,7 @@ import os
 import sys
 import lxml.etree as etree
 from functools import cmp_to_key
+import hashlib
 import re
 
 class InputFile:
@@ -35,6 +36,43 @@ class InputFile:
         self.offsetx = 0
         self.offsety = 0
         self.rotation = 0
+        self.transform = None
+        self.pos_cache = {}
+
+    # Whether the file is merged without any offset or rotation
+    @property
+    def is_identity(self):
+        return self.rotation == 0 and self.offsetx == 0 and self.offsety == 0
+
+    # Returns a function that offsets and rotates a position (x, y) according to
+    # the options of the file. The rotation is resolved once here rather than
+    # for each position.
+    def make_transform(self):
+        ox = self.offsetx
+        oy = self.offsety
+        if self.rotation == 0:
+            return lambda x, y: (x + ox, y + oy)
+        elif self.rotation == 90:
+            return lambda x, y: (-y + ox, x + oy)
+        elif self.rotation == 180:
+            return lambda x, y: (-x + ox, -y + oy)
+        elif self.rotation == 270:
+            return lambda x, y: (y + ox, -x + oy)
+        else:
+            assert False
+
+    # Offsets and rotates a position given as attribute values and returns the
+    # new attribute values. Wires and vias that are connected share positions
+    # and most positions lie on a grid, thus the results are cached so that
+    # each distinct position is parsed and formatted only once.
+    def transform_pos(self, x, y):
+        key = (x, y)
+        res = self.pos_cache.get(key)
+        if res == None:
+            newx, newy = self.transform(float(x), float(y))
+            res = (str(newx), str(newy))
+            self.pos_cache[key] = res
+        return res
 
 def print_usage_and_exit():
     print('''Usage:
@@ -105,6 +143,9 @@ def parse_args():
     if infile != None:
         infiles.append(infile)
 
+    for infile in infiles:
+        infile.transform = infile.make_transform()
+
     return (outfile, infiles)
 
 ''' Retrieves a child of lxml element el which matches the given criteria:
@@ -114,6 +155,9 @@ def parse_args():
     If child is not found, None is returned
 '''
 def find_child(el, tag, attrs = {}):
+    if len(attrs) == 0:
+        # ElementPath lookup is done in C
+        return el.find(tag)
     for child in el:
         if child.tag == tag:
             valid = True
@@ -125,6 +169,17 @@ def find_child(el, tag, attrs = {}):
                 return child
     return None
 
+''' Builds a dict that maps the value of the key attribute to the child of lxml
+    element el with the given tag. If several children have the same value,
+    the first one is used, consistently with find_child.
+'''
+def index_children(el, tag, key):
+    index = {}
+    for child in el:
+        if child.tag == tag:
+            index.setdefault(child.get(key), child)
+    return index
+
 ''' Same as find_child, except that if the child is not fould, a new one with
     the given tag is created.
 '''
@@ -134,7 +189,8 @@ def find_or_create_child(el, tag, attrs = {}):
         return child
     return etree.SubElement(el, tag)
 
-''' Compares two Xml trees
+''' Compares two Xml trees. The order of child elements and the text content,
+    including the tails of the elements, are ignored.
 '''
 def xml_tree_compare(a, b):
     # compare root node
@@ -142,20 +198,18 @@ def xml_tree_compare(a, b):
         return -1
     elif a.tag > b.tag:
         return 1
-    elif a.tail < b.tail:
-        return -1
-    elif a.tail > b.tail:
-        return 1
 
-    # compare attributes
-    aitems = a.attrib.items()
-    aitems.sort()
-    bitems = b.attrib.items()
-    bitems.sort()
-    if aitems < bitems:
-        return -1
-    elif aitems > bitems:
-        return 1
+    # compare the numbers of child nodes and attributes first as it's cheap
+    if len(a) != len(b):
+        return -1 if len(a) < len(b) else 1
+    if len(a.attrib) != len(b.attrib):
+        return -1 if len(a.attrib) < len(b.attrib) else 1
+
+    # compare attributes. Sorting is needed only to order differing nodes
+    if dict(a.attrib) != dict(b.attrib):
+        aitems = sorted(a.attrib.items())
+        bitems = sorted(b.attrib.items())
+        return -1 if aitems < bitems else 1
 
     # compare child nodes
     achildren = list(a)
@@ -173,45 +227,94 @@ def xml_tree_compare(a, b):
     # must be equal
     return 0
 
+# Maps elements of the output tree to the hashes of their subtrees. The output
+# subtrees that are compared against are not modified once they are added, so
+# the cache does not need to be invalidated. lxml elements do not support weak
+# references, thus the cache keeps the elements alive for the duration of the
+# merge, which the output tree does anyway.
+subtree_hash_cache = {}
+
+''' Returns a hash of the canonical (C14N 2.0) representation of the subtree
+    rooted at lxml element el. The tail of el is not included.
+'''
+def subtree_hash(el):
+    return hashlib.blake2b(etree.tostring(el, method="c14n2"),
+                           digest_size=16).digest()
+
+''' Same as subtree_hash, except that the result is cached
+'''
+def cached_subtree_hash(el):
+    h = subtree_hash_cache.get(el)
+    if h == None:
+        h = subtree_hash(el)
+        subtree_hash_cache[el] = h
+    return h
+
+''' Checks whether element out_el of the output tree is equivalent to element
+    in_el of an input file. Identical subtrees are detected by comparing their
+    hashes, otherwise the slower xml_tree_compare is used which ignores the
+    order of the child elements. Neither includes the tails of the elements.
+'''
+def xml_tree_equal(out_el, in_el):
+    if cached_subtree_hash(out_el) == subtree_hash(in_el):
+        return True
+    return xml_tree_compare(out_el, in_el) == 0
+
+''' Iterates the children of lxml element el that have the given tag. The
+    filtering is done by lxml. The iterated children may be moved out of el.
+    After the iteration an error is reported for any child with another tag.
+'''
+def iter_children_checked(el, tag, infile):
+    count = len(el)
+    for child in el.iterchildren(tag):
+        count -= 1
+        yield child
+
+    if count > 0:
+        for child in el:
+            if child.tag != tag:
+                print_file_error_and_exit(infile, child)
+
 def sync_child_error(el, tag, child, infile, err = None):
     if err == None:
         err = "Unsupported difference"
 
     el_child = find_child(el, tag)
     if el_child == None:
-        el.append(deepcopy(child))
-    elif xml_tree_compare(el_child, child) != 0:
+        el.append(child)
+    elif not xml_tree_equal(el_child, child):
         print_file_error_and_exit(infile, child, err + "\n" +
                                     etree.tostring(el_child).decode() + "\n" +
                                     etree.tostring(child).decode())
 
 def sync_child(el, tag, child):
     if find_child(el, tag) == None:
-        el.append(deepcopy(child))
+        el.append(child)
 
 # Merges /eagle/drawing/settings element
 def merge_xml_settings(out_el, in_el, infile):
-    for child in in_el:
-        if child.tag == "setting":
-            if len(child) > 0:
-                print_file_error_and_exit(infile, child, "Expected empty")
-
-            # find any setting matching attributes
-            attrs = child.attrib
-            attrs = { key : None for key, value in attrs.items() }
-
-            found = find_child(out_el, "setting", attrs)
-
-            if found == None:
-                out_el.append(deepcopy(child))
-            else:
-                # check if elements are equivalent
-                if xml_tree_compare(found, child) != 0:
-                    print_file_warning(infile, "Incompatible settings \n" +
-                                       etree.tostring(found).decode() + "\n" +
-                                       etree.tostring(child).decode())
+    # settings are identified by the names of their attributes
+    out_settings = {}
+    for setting in out_el:
+        out_settings.setdefault(frozenset(setting.keys()), setting)
+
+    for child in iter_children_checked(in_el, "setting", infile):
+        if len(child) > 0:
+            print_file_error_and_exit(infile, child, "Expected empty")
+
+        # find the setting with matching attributes
+        keys = frozenset(child.keys())
+        found = out_settings.get(keys)
+
+        if found == None:
+            out_el.append(child)
+            out_settings[keys] = child
         else:
-            print_file_error_and_exit(infile, child)
+            # check if elements are equivalent
+            if not xml_tree_equal(found, child):
+                print_file_warning(infile, "Incompatible settings \n" +
+                                   etree.tostring(found).decode() + "\n" +
+                                   etree.tostring(child).decode())
 
     if len(in_el.attrib) > 0:
         print_file_error_and_exit(infile, in_el, "Unexpected attributes")
@@ -219,55 +322,44 @@ def merge_xml_settings(out_el, in_el, infile):
 # Merges /eagle/drawing/layers element
 def merge_xml_layers(out_el, in_el, infile):
     # we only ensure that layer exists, layer info differences are ignored.
-    for child in in_el:
-        if child.tag == "layer":
-            if find_child(out_el, "layer", { "number" : child.get("number") }) == None:
-                out_el.append(deepcopy(child))
-        else:
-            print_file_error_and_exit(infile, child)
+    out_layers = index_children(out_el, "layer", "number")
+    for child in iter_children_checked(in_el, "layer", infile):
+        if child.get("number") not in out_layers:
+            out_el.append(child)
+            out_layers[child.get("number")] = child
 
     if len(in_el.attrib) > 0:
         print_file_error_and_exit(infile, in_el, "Unexpected attributes")
 
-def offset_and_rotate(x, y, infile):
-    if infile.rotation == 0:
-        pass
-    elif infile.rotation == 90:
-        tmp = -y
-        y = x
-        x = tmp
-    elif infile.rotation == 180:
-        x = -x
-        y = -y
-    elif infile.rotation == 270:
-        tmp = y
-        y = -x
-        x = tmp
-    else:
-        assert False
-
-    x += infile.offsetx
-    y += infile.offsety
-    return x, y
-
 def update_xml_routing_pos(el, xattr, yattr, infile):
     x = el.get(xattr)
     y = el.get(yattr)
     if x == None or y == None:
         print_file_error_and_exit(infile, el)
-    x, y = offset_and_rotate(float(x), float(y), infile)
-    el.set(xattr, str(x))
-    el.set(yattr, str(y))
+    if infile.is_identity:
+        # the position stays the same
+        return
+    x, y = infile.transform_pos(x, y)
+    el.set(xattr, x)
+    el.set(yattr, y)
+
+# Matches the value of rotation attributes, e.g. R90 or MR180. The letters are
+# the mirror (M), spin (S) and rotation (R) flags.
+ROTATION_RE = re.compile(r"^([MSR]*)(\d+)$")
 
 def update_xml_routing_rot(el, rotattr, infile):
-    rot = el.get(rotattr)
-    if rot == None or rot == "":
-        rot = "R0"
-    m = re.match(r"^([a-zA-Z]*)(\d+)$", rot)
-    if m == None:
-        print_file_error_and_exit(infile, el, "Unsupported rotation attribute " + rot)
-    prefix = m.group(1)
-    introt = int(m.group(2))
+    old_rot = el.get(rotattr)
+    rot = old_rot
+    if rot == None or rot == "" or rot == "R0":
+        # the default rotation
+        prefix = "R"
+        introt = 0
+    else:
+        m = ROTATION_RE.match(rot)
+        if m == None:
+            print_file_error_and_exit(infile, el, "Unsupported rotation attribute " + rot)
+        prefix = m.group(1)
+        introt = int(m.group(2))
 
     # rotate mirrored parts to opposite direction
     if "M" in prefix:
@@ -276,72 +368,61 @@ def update_xml_routing_rot(el, rotattr, infile):
         introt = (introt + infile.rotation) % 360
     rot = prefix + str(introt)
 
-    if el.get(rotattr) == None and rot == "R0":
+    if rot == old_rot or (old_rot == None and rot == "R0"):
         # no changes needed
         return
     el.set(rotattr, rot)
 
+# Describes how update_routing updates each element that may be found within
+# plain, signal and elements nodes: the pairs of position attributes, the
+# rotation attribute or None, and whether the child nodes are updated too.
+ROUTING_UPDATES = {
+    # in plain or signal
+    "wire" : ((("x1", "y1"), ("x2", "y2")), None, False),
+    # in plain or signal, the vertex nodes are processed
+    "polygon" : ((), None, True),
+    # in plain
+    "text" : ((("x", "y"),), "rot", False),
+    "dimension" : ((("x1", "y1"), ("x2", "y2"), ("x3", "y3")), None, False),
+    "circle" : ((("x", "y"),), None, False),
+    # note that we are ignoring rotation as it will be dealt with by changing
+    # the positions of the corners of the rectangle
+    "rectangle" : ((("x1", "y1"), ("x2", "y2")), None, False),
+    "frame" : ((("x1", "y1"), ("x2", "y2")), None, False),
+    "hole" : ((("x", "y"),), None, False),
+    # in signal
+    "contactref" : ((), None, False),
+    "via" : ((("x", "y"),), None, False),
+    # in elements, the attribute and variant nodes are processed
+    "element" : ((("x", "y"),), "rot", True),
+    # in polygon
+    "vertex" : ((("x", "y"),), None, False),
+    # in element
+    "attribute" : ((("x", "y"),), "rot", False),
+    "variant" : ((), None, False),
+}
+
 # Updates the elements within the following nodes and all their sub-nodes:
 # plain, signal, elements
 # This is where the actual position and rotation modifications are made
 def update_routing(el, infile):
-    if el.tag == "wire":
-        # in plain or signal
-        update_xml_routing_pos(el, "x1", "y1", infile)
-        update_xml_routing_pos(el, "x2", "y2", infile)
-    elif el.tag == "polygon":
-        # in plain or signal
-        for child in el:
-            update_routing(child, infile) # process vertex nodes
-    elif el.tag == "text":
-        # in plain
-        update_xml_routing_pos(el, "x", "y", infile)
-        update_xml_routing_rot(el, "rot", infile)
-    elif el.tag == "dimension":
-        # in plain
-        update_xml_routing_pos(el, "x1", "y1", infile)
-        update_xml_routing_pos(el, "x2", "y2", infile)
-        update_xml_routing_pos(el, "x3", "y3", infile)
-    elif el.tag == "circle":
-        # in plain
-        update_xml_routing_pos(el, "x", "y", infile)
-    elif el.tag == "rectangle":
-        # in plain
-        update_xml_routing_pos(el, "x1", "y1", infile)
-        update_xml_routing_pos(el, "x2", "y2", infile)
-        # note that we are ignoring rotation as it will be dealt with by
-        # changing the positions of the corners of the rectangle
-    elif el.tag == "frame":
-        # in plain
-        update_xml_routing_pos(el, "x1", "y1", infile)
-        update_xml_routing_pos(el, "x2", "y2", infile)
-    elif el.tag == "hole":
-        # in plain
-        update_xml_routing_pos(el, "x", "y", infile)
-    elif el.tag == "contactref":
-        # in signal
-        pass
-    elif el.tag == "via":
-        # in signal
-        update_xml_routing_pos(el, "x", "y", infile)
-    elif el.tag == "element":
-        # in elements
-        update_xml_routing_pos(el, "x", "y", infile)
-        update_xml_routing_rot(el, "rot", infile)
-        for child in el:
-            update_routing(child, infile) # process attribute or variant nodes
-    elif el.tag == "vertex":
-        # in polygon
-        update_xml_routing_pos(el, "x", "y", infile)
-    elif el.tag == "attribute":
-        # in element
-        update_xml_routing_pos(el, "x", "y", infile)
-        update_xml_routing_rot(el, "rot", infile)
-    elif el.tag == "variant":
-        # in element
-        pass
-    else:
-        print_file_error_and_exit(infile, el)
+    stack = [el]
+    while len(stack) > 0:
+        el = stack.pop()
+        update = ROUTING_UPDATES.get(el.tag)
+        if update == None:
+            print_file_error_and_exit(infile, el)
+
+        pos_attrs, rot_attr, update_children = update
+        for xattr, yattr in pos_attrs:
+            update_xml_routing_pos(el, xattr, yattr, infile)
+        if rot_attr != None:
+            update_xml_routing_rot(el, rot_attr, infile)
+        if update_children:
+            stack.extend(el)
+
+# Retrieves the attribute children of an element with the given name
+find_attribute_by_name = etree.XPath("attribute[@name=$name]")
 
 # Hides the current name label and adds a custom label that is displayed as if
 # the element has old_name.
@@ -349,9 +430,10 @@ def override_name_label(el, old_name):
 
     if el.get("name") == old_name:
         return
-    name_attr = find_child(el, "attribute", { "name" : "NAME" })
-    if name_attr == None:
+    name_attrs = find_attribute_by_name(el, name="NAME")
+    if len(name_attrs) == 0:
         return
+    name_attr = name_attrs[0]
     name_attr_dup = deepcopy(name_attr)
     name_attr_dup.set("name", "NAME1")
     name_attr_dup.set("value", old_name)
@@ -362,9 +444,8 @@ def override_name_label(el, old_name):
 def append_xml_plain(out_el, in_el, infile):
 
     for child in in_el:
-        new_child = deepcopy(child)
-        out_el.append(new_child)
-        update_routing(new_child, infile)
+        out_el.append(child)
+        update_routing(child, infile)
 
     if len(in_el.attrib) > 0:
         print_file_error_and_exit(infile, in_el, "Unexpected attributes")
@@ -372,19 +453,18 @@ def append_xml_plain(out_el, in_el, infile):
 # Merges /eagle/drawing/board/libraries/library/packages element
 def merge_xml_packages(out_el, in_el, infile):
 
-    for child in in_el:
-        if child.tag == "package":
-            out_child = find_child(out_el, "package", { "name" : child.get("name") })
-            if out_child == None:
-                out_el.append(deepcopy(child))
-            else:
-                if xml_tree_compare(out_child, child) != 0:
-                    err = "Embedded libraries contain different packages of the same name {0}\n".format(child.get("name"))
-                    err += etree.tostring(out_child).decode() + "\n"
-                    err += etree.tostring(child).decode()
-                    print_file_error_and_exit(infile, child, err)
+    out_packages = index_children(out_el, "package", "name")
+    for child in iter_children_checked(in_el, "package", infile):
+        out_child = out_packages.get(child.get("name"))
+        if out_child == None:
+            out_el.append(child)
+            out_packages[child.get("name")] = child
         else:
-            print_file_error_and_exit(infile, child)
+            if not xml_tree_equal(out_child, child):
+                err = "Embedded libraries contain different packages of the same name {0}\n".format(child.get("name"))
+                err += etree.tostring(out_child).decode() + "\n"
+                err += etree.tostring(child).decode()
+                print_file_error_and_exit(infile, child, err)
 
     if len(in_el.attrib) > 0:
         print_file_error_and_exit(infile, in_el, "Unexpected attributes")
@@ -407,11 +487,13 @@ def merge_xml_library(out_el, in_el, infile):
 # Merges /eagle/drawing/board/libraries element
 def merge_xml_libraries(out_el, in_el, infile):
 
+    out_libraries = index_children(out_el, "library", "name")
     for child in in_el:
         if child.tag == "library":
-            out_child = find_child(out_el, "library", { "name" : child.get("name") })
+            out_child = out_libraries.get(child.get("name"))
             if out_child == None:
-                out_el.append(deepcopy(child))
+                out_el.append(child)
+                out_libraries[child.get("name")] = child
             else:
                 merge_xml_library(out_child, child, infile)
         else:
@@ -420,35 +502,46 @@ def merge_xml_libraries(out_el, in_el, infile):
     if len(in_el.attrib) > 0:
         print_file_error_and_exit(infile, in_el, "Unexpected attributes")
 
+# Maps elements of the output tree to dicts that map names of their children to
+# the postfix number to try first when the name is taken again. Postfixes below
+# that number are known to be taken already, as names are never removed.
+next_name_postfixes = {}
+
+''' Returns the given name if it is not among the keys of names, otherwise
+    appends the separator and the lowest postfix number that makes it unique.
+    next_postfix caches the postfix number to try next for each name.
+'''
+def make_unique_name(name, names, separator, next_postfix):
+    if name not in names:
+        return name
+    postfix_num = next_postfix.get(name, 1)
+    while name + separator + str(postfix_num) in names:
+        postfix_num += 1
+    next_postfix[name] = postfix_num + 1
+    return name + separator + str(postfix_num)
+
 # Merges /eagle/drawing/board/elements element
 # Eagle requires that real names of elements are not duplicated, thus this
 # function ensures that a unique name is used. The label is overridden to
 # display the old name by defining a custom attribute.
 def append_xml_elements(out_el, in_el, element_map, infile):
 
-    for child in in_el:
-        if child.tag == "element":
-            new_child = deepcopy(child)
-            update_routing(new_child, infile)
-
-            # make sure the name of the new signal is unique
-            name = new_child.get("name")
-            prev_name = name
-            postfix = ""
-            postfix_num = 1
-            while find_child(out_el, "element", { "name" : name + postfix }) != None:
-                postfix = "_" + str(postfix_num)
-                postfix_num += 1
-            name = name + postfix
-
-            new_child.set("name", name)
-            if name != prev_name:
-                element_map[prev_name] = name
-                override_name_label(new_child, prev_name)
-
-            out_el.append(new_child)
-        else:
-            print_file_error_and_exit(infile, child)
+    out_elements = index_children(out_el, "element", "name")
+    for child in iter_children_checked(in_el, "element", infile):
+        update_routing(child, infile)
+
+        # make sure the name of the new signal is unique
+        prev_name = child.get("name")
+        name = make_unique_name(prev_name, out_elements, "_",
+                                next_name_postfixes.setdefault(out_el, {}))
+
+        child.set("name", name)
+        if name != prev_name:
+            element_map[prev_name] = name
+            override_name_label(child, prev_name)
+
+        out_el.append(child)
+        out_elements[name] = child
 
     if len(in_el.attrib) > 0:
         print_file_error_and_exit(infile, in_el, "Unexpected attributes")
@@ -463,26 +556,22 @@ def update_signal_element_names(el, element_map):
 # Merges /eagle/drawing/board/signals element
 def append_xml_signals(out_el, in_el, element_map, infile):
 
-    for child in in_el:
-        if child.tag == "signal":
-            new_child = deepcopy(child)
-            for new_child2 in new_child:
-                update_routing(new_child2, infile)
-                update_signal_element_names(new_child2, element_map)
-
-            # make sure the name of the new signal is unique
-            name = new_child.get("name")
-            postfix = ""
-            postfix_num = 1
-            while find_child(out_el, "signal", { "name" : name + postfix }) != None:
-                postfix = str(postfix_num)
-                postfix_num += 1
-            name = name + postfix
-
-            new_child.set("name", name)
-            out_el.append(new_child)
-        else:
-            print_file_error_and_exit(infile, child)
+    out_signals = index_children(out_el, "signal", "name")
+    # the contact references need to be updated only if elements were renamed
+    update_names = len(element_map) > 0
+    for child in iter_children_checked(in_el, "signal", infile):
+        for child2 in child:
+            update_routing(child2, infile)
+            if update_names:
+                update_signal_element_names(child2, element_map)
+
+        # make sure the name of the new signal is unique
+        name = make_unique_name(child.get("name"), out_signals, "",
+                                next_name_postfixes.setdefault(out_el, {}))
+
+        child.set("name", name)
+        out_el.append(child)
+        out_signals[name] = child
 
     if len(in_el.attrib) > 0:
         print_file_error_and_exit(infile, in_el, "Unexpected attributes")
@@ -492,61 +581,76 @@ def append_xml_errors(out_el, in_el, infile):
     # TODO
     pass
 
-# Merges /eagle/drawing/board element
-def merge_xml_board(out_el, in_el, infile):
+# Merges a child of /eagle/drawing/board element
+def merge_xml_board_section(out_el, in_el, element_map, infile):
+    if in_el.tag == "plain":
+        append_xml_plain(find_or_create_child(out_el, "plain"), in_el, infile)
+    elif in_el.tag == "libraries":
+        merge_xml_libraries(find_or_create_child(out_el, "libraries"), in_el, infile)
+    elif in_el.tag == "attributes":
+        sync_child_error(out_el, "attributes", in_el, infile) # differences not supported
+    elif in_el.tag == "variantdefs":
+        sync_child_error(out_el, "variantdefs", in_el, infile) # differences not supported
+    elif in_el.tag == "classes":
+        sync_child_error(out_el, "classes", in_el, infile) # differences not supported
+    elif in_el.tag == "designrules":
+        # ensure that design rule info is equivalent
+        sync_child_error(out_el, "designrules", in_el, infile, "Design rules must be equivalent")
+    elif in_el.tag == "autorouter":
+        # we just take the autorouter element of the first file it exists
+        sync_child(out_el, "autorouter", in_el)
+    elif in_el.tag == "elements":
+        append_xml_elements(find_or_create_child(out_el, "elements"), in_el, element_map, infile)
+    elif in_el.tag == "signals":
+        append_xml_signals(find_or_create_child(out_el, "signals"), in_el, element_map, infile)
+    elif in_el.tag == "errors":
+        append_xml_errors(find_or_create_child(out_el, "errors"), in_el, infile)
+    else:
+        print_file_error_and_exit(infile, in_el)
 
-    # Element names must be unique; this dict stores the old->new name mapping
-    element_map = {}
+# Merges /eagle/drawing/board element. The sections of the element have
+# already been merged and removed by merge_xml_file, anything that is left is
+# not supported.
+def merge_xml_board(in_el, infile):
 
     for child in in_el:
-        if child.tag == "plain":
-            append_xml_plain(find_or_create_child(out_el, "plain"), child, infile)
-        elif child.tag == "libraries":
-            merge_xml_libraries(find_or_create_child(out_el, "libraries"), child, infile)
-        elif child.tag == "attributes":
-            sync_child_error(out_el, "attributes", child, infile) # differences not supported
-        elif child.tag == "variantdefs":
-            sync_child_error(out_el, "variantdefs", child, infile) # differences not supported
-        elif child.tag == "classes":
-            sync_child_error(out_el, "classes", child, infile) # differences not supported
-        elif child.tag == "designrules":
-            # ensure that design rule info is equivalent
-            sync_child_error(out_el, "designrules", child, infile, "Design rules must be equivalent")
-        elif child.tag == "autorouter":
-            # we just take the autorouter element of the first file it exists
-            sync_child(out_el, "autorouter", child)
-        elif child.tag == "elements":
-            append_xml_elements(find_or_create_child(out_el, "elements"), child, element_map, infile)
-        elif child.tag == "signals":
-            append_xml_signals(find_or_create_child(out_el, "signals"), child, element_map, infile)
-        elif child.tag == "errors":
-            append_xml_errors(find_or_create_child(out_el, "errors"), child, infile)
-        else:
-            print_file_error_and_exit(infile, child)
+        print_file_error_and_exit(infile, child)
 
     if len(in_el.attrib) > 0:
         print_file_error_and_exit(infile, in_el, "Unexpected attributes")
 
-# Merges /eagle/drawing element
-def merge_xml_drawing(out_el, in_el, infile):
+# Merges a child of /eagle/drawing element
+def merge_xml_drawing_section(out_el, in_el, infile):
+    if in_el.tag == "settings":
+        merge_xml_settings(find_or_create_child(out_el, "settings"), in_el, infile)
+    elif in_el.tag == "grid":
+        # we just take the grid element of the first file
+        sync_child(out_el, "grid", in_el)
+    elif in_el.tag == "layers":
+        merge_xml_layers(find_or_create_child(out_el, "layers"), in_el, infile)
+    elif in_el.tag == "board":
+        merge_xml_board(in_el, infile)
+    else:
+        print_file_error_and_exit(infile, in_el)
+
+# Merges /eagle/drawing element. Similarly to merge_xml_board, the sections
+# have already been merged and removed.
+def merge_xml_drawing(in_el, infile):
 
     for child in in_el:
-        if child.tag == "settings":
-            merge_xml_settings(find_or_create_child(out_el, "settings"), child, infile)
-        elif child.tag == "grid":
-            # we just take the grid element of the first file
-            sync_child(out_el, "grid", child)
-        elif child.tag == "layers":
-            merge_xml_layers(find_or_create_child(out_el, "layers"), child, infile)
-        elif child.tag == "board":
-            merge_xml_board(find_or_create_child(out_el, "board"), child, infile)
-        else:
-            print_file_error_and_exit(infile, child)
+        print_file_error_and_exit(infile, child)
 
     if len(in_el.attrib) > 0:
         print_file_error_and_exit(infile, in_el, "Unexpected attributes")
 
-# Merges /eagle element
+# Merges a child of /eagle element
+def merge_xml_eagle_section(in_el, infile):
+    if in_el.tag == "drawing":
+        merge_xml_drawing(in_el, infile)
+    elif in_el.tag == "compatibility":
+        print_file_warning(infile, "Compatibility notes ignored")
+
+# Merges the attributes of /eagle element
 def merge_xml_eagle(out_el, in_el, infile):
     assert out_el.tag == "eagle" and in_el.tag == "eagle"
 
@@ -564,12 +668,75 @@ def merge_xml_eagle(out_el, in_el, infile):
         else:
             print_file_error_and_exit(infile, in_el, "Unexpected attributes")
 
+# The elements that are merged by merge_xml_file as soon as they are parsed
+MERGED_TAGS = ("eagle", "compatibility", "drawing", "settings", "grid",
+               "layers", "board", "plain", "libraries", "attributes",
+               "variantdefs", "classes", "designrules", "autorouter",
+               "elements", "signals", "errors")
+
+# The tags of the parents of the sections merged by merge_xml_file and of their
+# ancestors up to the root
+SECTION_PARENT_PATHS = (["board", "drawing", "eagle"], ["drawing", "eagle"],
+                        ["eagle"])
+
+# Options of the parser of the input files. Large boards may exceed the default
+# safety limits of libxml2. IDs are not used and entities are not expected.
+PARSER_OPTIONS = { "huge_tree" : True, "collect_ids" : False,
+                   "resolve_entities" : False }
+
+# Merges the given input file into /eagle element out_el. The file is parsed
+# incrementally and each section of it is removed from the input tree once it
+# has been merged, thus only a single section is kept in memory at a time.
+# The merged subtrees are moved from the input tree to the output tree instead
+# of being copied.
+def merge_xml_file(out_el, infile):
 
-    for child in in_el:
-        if child.tag == "drawing":
-            merge_xml_drawing(find_or_create_child(out_el, "drawing"), child, infile)
-        elif child.tag == "compatibility":
-            print_file_warning(infile, "Compatibility notes ignored")
+    # Element names must be unique; this dict stores the old->new name mapping
+    element_map = {}
+
+    context = etree.iterparse(infile.path, events=("start", "end"),
+                              tag=MERGED_TAGS, **PARSER_OPTIONS)
+    for event, el in context:
+        parent = el.getparent()
+        if parent == None:
+            if event == "start":
+                if el.tag != "eagle":
+                    print_file_error_and_exit(infile, el, "Not an Eagle file")
+                merge_xml_eagle(out_el, el, infile)
+            continue
+        if event != "end":
+            continue
+
+        # the tags of the parent and its ancestors up to the root
+        path = [parent.tag] + [a.tag for a in parent.iterancestors()]
+        if path not in SECTION_PARENT_PATHS:
+            # not a section, e.g. an element nested within a library or
+            # within a root element other than eagle
+            continue
+
+        # Depending on where the read buffer of the parser ends, the tail of the
+        # section may not have been parsed yet. The tail is only formatting,
+        # thus it is dropped so that neither the comparisons nor the output
+        # depend on the buffer boundaries.
+        el.tail = None
+
+        if path == ["board", "drawing", "eagle"]:
+            out_drawing = find_or_create_child(out_el, "drawing")
+            merge_xml_board_section(find_or_create_child(out_drawing, "board"),
+                                    el, element_map, infile)
+        elif path == ["drawing", "eagle"]:
+            merge_xml_drawing_section(find_or_create_child(out_el, "drawing"),
+                                      el, infile)
+        else:
+            merge_xml_eagle_section(el, infile)
+
+        # the section may have been moved to the output tree as a whole
+        if el.getparent() == parent:
+            parent.remove(el)
+
+    # the root element is not reported by iterparse if it has an unknown tag
+    if context.root.tag != "eagle":
+        print_file_error_and_exit(infile, context.root, "Not an Eagle file")
 
 def main():
     outfile, infiles = parse_args()
@@ -580,12 +747,14 @@ def main():
             print("Input file {0} not found!".format(infile.path))
             sys.exit(1)
 
-        in_el = etree.parse(infile.path)
-        merge_xml_eagle(out_el, in_el.getroot(), infile)
+        merge_xml_file(out_el, infile)
 
-    open(outfile, "wb").write(etree.tostring(out_el, xml_declaration=True,
-                                            encoding="UTF-8",
-                                            doctype="<!DOCTYPE eagle SYSTEM \"eagle.dtd\">"))
+    # serialize directly to the file instead of building the whole document
+    # in memory first
+    with etree.xmlfile(outfile, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        xf.write_doctype("<!DOCTYPE eagle SYSTEM \"eagle.dtd\">")
+        xf.write(out_el)
 
 if __name__ == "__main__":
     main()